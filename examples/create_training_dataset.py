@@ -13,33 +13,139 @@ It can:
 import os
 import sys
 import argparse
+import multiprocessing
+import queue
 import random
+import shutil
+import tarfile
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+from multiprocessing.shared_memory import SharedMemory
 from pathlib import Path
 from PIL import Image
 import numpy as np
-from typing import Tuple, List, Optional
+from tqdm import tqdm
+from typing import Tuple, List, Optional, Union
 
-def create_patches(image: Image.Image, patch_size: int, stride: Optional[int] = None) -> List[Image.Image]:
-    """Extract patches from an image."""
+try:
+    import cv2
+    # Parallelism comes from the worker processes; keep OpenCV single-threaded
+    cv2.setNumThreads(1)
+except ImportError:
+    cv2 = None
+
+# Threads per worker process used to encode and write PNG patches
+_SAVE_THREADS = 4
+
+# Decoded images buffered between the decode and patch stages of a worker.
+# Later stages are slower, so the decode thread only needs to stay one image
+# ahead; each buffered image is a full RGB copy of a source photo
+_DECODE_DEPTH = 1
+
+# Patch batches buffered between the patch and save stages of a worker. A
+# batch holds every augmented HR/LR patch of an image and saving is the slowest
+# stage, so this queue stays full; deeper buffering costs far more memory than
+# it gains in speed
+_CUT_DEPTH = 1
+
+# Upper bound on the images handed to a worker process per task
+_IMAGES_PER_TASK = 16
+
+# Target size of one shared-memory slot when handing npy/tar patches back to
+# the parent
+_SLOT_BYTES = 64 * 1024 * 1024
+
+# Upper bound on the whole shared-memory ring; images whose patches do not fit
+# a slot are pickled back through the pool instead
+_RING_BYTES = 512 * 1024 * 1024
+
+def _patch_grid(size: Tuple[int, int], patch_size: int, stride: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Top-left y and x coordinates of every patch in an image of the given size."""
+    width, height = size
+    ys = np.arange(0, height - patch_size + 1, stride)
+    xs = np.arange(0, width - patch_size + 1, stride)
+    return ys, xs
+
+def create_patches(
+    image: Union[Image.Image, np.ndarray],
+    patch_size: int,
+    stride: Optional[int] = None,
+    keep: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Extract patches from an image as an (n, patch, patch, 3) array.
+    
+    The patch grid is a zero-copy sliding-window view of the image. `keep` is
+    an optional boolean (rows, cols) mask over that grid; only the selected
+    patches are copied out, in row-major order.
+    """
     if stride is None:
         stride = patch_size
     
-    patches = []
-    width, height = image.size
+    array = np.asarray(image)
+    windows = np.lib.stride_tricks.sliding_window_view(array, (patch_size, patch_size, array.shape[2]))
+    windows = windows[::stride, ::stride, 0]
+    if keep is not None:
+        return windows[keep]
+    return windows.reshape(-1, patch_size, patch_size, array.shape[2])
+
+def _patch_variances(array: np.ndarray, ys: np.ndarray, xs: np.ndarray, patch_size: int, stride: int) -> np.ndarray:
+    """Pixel variance of every patch on the (ys, xs) grid.
+    
+    Sums of x and x^2 are exact int64 sums of the uint8 data, so there is no
+    float promotion of the image and no square root. Non-overlapping patches
+    are summed directly; overlapping ones use integral images, so each patch
+    costs four lookups instead of a pass over its pixels.
+    """
+    height, width, channels = array.shape
+    n = patch_size * patch_size * channels
+    
+    if stride >= patch_size:
+        # Each pixel is read at most once, so building full-image tables would only add work
+        windows = np.lib.stride_tricks.sliding_window_view(array, (patch_size, patch_size, channels))
+        windows = windows[::stride, ::stride, 0]
+        total = windows.sum(axis=(2, 3, 4), dtype=np.int64)
+        squared = np.empty_like(total)
+        # Square one row of patches at a time to keep the uint32 temporary small
+        for out, row in zip(squared, windows):
+            out[:] = np.square(row, dtype=np.uint32).sum(axis=(1, 2, 3), dtype=np.int64)
+        return (n * squared - total * total) / (n * n)
     
-    for y in range(0, height - patch_size + 1, stride):
-        for x in range(0, width - patch_size + 1, stride):
-            patch = image.crop((x, y, x + patch_size, y + patch_size))
-            patches.append(patch)
+    # Accumulate one channel at a time straight into the tables, so the only
+    # temporary is a single uint16 plane of squares
+    sums = np.zeros((height + 1, width + 1), dtype=np.int64)
+    squares = np.zeros((height + 1, width + 1), dtype=np.int64)
+    square = np.empty((height, width), dtype=np.uint16)
+    for channel in np.moveaxis(array, 2, 0):
+        sums[1:, 1:] += channel
+        squares[1:, 1:] += np.square(channel, out=square, dtype=np.uint16)
+    for table in (sums, squares):
+        np.cumsum(table[1:, 1:], axis=0, out=table[1:, 1:])
+        np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
     
-    return patches
+    y0, x0 = ys[:, None], xs[None, :]
+    y1, x1 = y0 + patch_size, x0 + patch_size
+    
+    def window(table):
+        return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+    
+    # var = E[x^2] - E[x]^2, with the numerator kept in integers
+    total = window(sums)
+    return (n * window(squares) - total * total) / (n * n)
 
 def downscale_image(image: Image.Image, scale: int, method: str = 'bicubic') -> Image.Image:
     """Downscale an image by a factor."""
     width, height = image.size
     new_size = (width // scale, height // scale)
     
+    # OpenCV's INTER_AREA is the same area average as BOX, and faster than stock Pillow
+    if cv2 is not None and method == 'box':
+        return Image.fromarray(cv2.resize(np.asarray(image), new_size, interpolation=cv2.INTER_AREA))
+    
     resample_methods = {
+        'box': Image.BOX,
         'bicubic': Image.BICUBIC,
         'bilinear': Image.BILINEAR,
         'lanczos': Image.LANCZOS,
@@ -49,22 +155,420 @@ def downscale_image(image: Image.Image, scale: int, method: str = 'bicubic') ->
     method_enum = resample_methods.get(method, Image.BICUBIC)
     return image.resize(new_size, method_enum)
 
-def augment_image(image: Image.Image, augmentations: List[str]) -> List[Image.Image]:
-    """Apply data augmentations to an image."""
-    augmented = [image]
+def downscale_patches(patches: np.ndarray, scale: int, method: str = 'bicubic') -> np.ndarray:
+    """Downscale an (n, height, width, 3) batch of patches by a factor.
+    
+    With BOX filtering and a patch size divisible by the scale no output pixel
+    straddles two patches, so they are stacked into one strip and resized with
+    a single call.
+    """
+    count, height, width, channels = patches.shape
+    if count == 0:
+        return np.empty((0, height // scale, width // scale, channels), dtype=patches.dtype)
+    
+    if method != 'box' or width % scale or height % scale:
+        return np.stack([np.asarray(downscale_image(Image.fromarray(patch), scale, method))
+                         for patch in patches])
+    
+    strip = Image.fromarray(np.ascontiguousarray(patches).reshape(count * height, width, channels))
+    lr_strip = np.asarray(downscale_image(strip, scale, method))
+    return lr_strip.reshape(count, height // scale, width // scale, channels)
+
+def augment_batch(batch: np.ndarray, augmentations: List[str]) -> np.ndarray:
+    """Apply data augmentations to an (n, height, width, 3) batch of patches.
+    
+    Returns the original batch followed by one augmented copy of the whole
+    batch per transform.
+    """
+    augmented = [batch]
     
     if 'flip_h' in augmentations:
-        augmented.append(image.transpose(Image.FLIP_LEFT_RIGHT))
+        augmented.append(batch[:, :, ::-1])
     
     if 'flip_v' in augmentations:
-        augmented.append(image.transpose(Image.FLIP_TOP_BOTTOM))
+        augmented.append(batch[:, ::-1, :])
     
     if 'rotate_90' in augmentations:
-        augmented.append(image.rotate(90, expand=True))
-        augmented.append(image.rotate(180, expand=True))
-        augmented.append(image.rotate(270, expand=True))
+        augmented.append(np.rot90(batch, k=1, axes=(1, 2)))
+        augmented.append(np.rot90(batch, k=2, axes=(1, 2)))
+        augmented.append(np.rot90(batch, k=3, axes=(1, 2)))
+    
+    return np.concatenate(augmented, axis=0)
+
+def _estimate_patches(path: Path, patch_size: int, stride: int, copies: int) -> int:
+    """Upper bound on the number of patches an image can produce.
+    
+    Only the image header is read; the low-variance filter can only lower the count.
+    Unreadable images count as 0.
+    """
+    try:
+        with Image.open(path) as image:
+            ys, xs = _patch_grid(image.size, patch_size, stride)
+    except Exception:
+        return 0
+    return len(ys) * len(xs) * copies
+
+def _truncate_npy(path: Path, rows: int):
+    """Shrink a .npy file created with open_memmap to its first `rows` entries.
+    
+    The header is rewritten in place, padded to its original length, so the
+    data offset does not move and the file can simply be truncated.
+    """
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            prefix = 10
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            prefix = 12
+        data_offset = f.tell()
+        
+        shape = (rows,) + shape[1:]
+        header = repr({'descr': np.lib.format.dtype_to_descr(dtype),
+                       'fortran_order': fortran_order,
+                       'shape': shape})
+        f.seek(prefix)
+        f.write((header.ljust(data_offset - prefix - 1) + '\n').encode('latin1'))
+        f.truncate(data_offset + dtype.itemsize * int(np.prod(shape)))
+
+class _NpyWriter:
+    """Appends patch pairs to preallocated, memory-mapped .npy arrays.
     
-    return augmented
+    Writes <split>_hr.npy, <split>_lr.npy and <split>_index.txt, which names
+    the source image and patch number of every row.
+    """
+    
+    def __init__(self, output_dir: Path, split: str, capacity: int, patch_size: int, lr_size: int):
+        self.hr_path = output_dir / f'{split}_hr.npy'
+        self.lr_path = output_dir / f'{split}_lr.npy'
+        self.index_path = output_dir / f'{split}_index.txt'
+        # A zero-length memmap cannot be created; the file is truncated on close anyway
+        capacity = max(capacity, 1)
+        self.hr = np.lib.format.open_memmap(self.hr_path, mode='w+', dtype=np.uint8,
+                                            shape=(capacity, patch_size, patch_size, 3))
+        self.lr = np.lib.format.open_memmap(self.lr_path, mode='w+', dtype=np.uint8,
+                                            shape=(capacity, lr_size, lr_size, 3))
+        self.keys = []
+        self.count = 0
+    
+    def write(self, stem: str, hr: np.ndarray, lr: np.ndarray):
+        end = self.count + len(hr)
+        self.hr[self.count:end] = hr
+        self.lr[self.count:end] = lr
+        self.keys.extend(f"{stem}_{idx:04d}" for idx in range(len(hr)))
+        self.count = end
+    
+    def close(self):
+        self.hr.flush()
+        self.lr.flush()
+        del self.hr, self.lr
+        _truncate_npy(self.hr_path, self.count)
+        _truncate_npy(self.lr_path, self.count)
+        with open(self.index_path, 'w') as f:
+            f.writelines(f"{key}\n" for key in self.keys)
+
+class _TarWriter:
+    """Writes patch pairs to a WebDataset-style tar shard.
+    
+    Each sample is stored as <image>_<patch>.hr.npy and <image>_<patch>.lr.npy.
+    """
+    
+    def __init__(self, output_dir: Path, split: str):
+        self.tar = tarfile.open(output_dir / f'{split}.tar', 'w')
+        self.count = 0
+    
+    def _add(self, name: str, array: np.ndarray):
+        buffer = BytesIO()
+        np.save(buffer, array)
+        info = tarfile.TarInfo(name)
+        info.size = buffer.tell()
+        buffer.seek(0)
+        self.tar.addfile(info, buffer)
+    
+    def write(self, stem: str, hr: np.ndarray, lr: np.ndarray):
+        for idx, (hr_patch, lr_patch) in enumerate(zip(hr, lr)):
+            key = f"{stem}_{idx:04d}"
+            self._add(f"{key}.hr.npy", hr_patch)
+            self._add(f"{key}.lr.npy", lr_patch)
+        self.count += len(hr)
+    
+    def close(self):
+        self.tar.close()
+
+def _save_png(array: np.ndarray, path: Path, compress_level: int):
+    """Save an RGB image array as PNG."""
+    if cv2 is not None:
+        # OpenCV encodes straight from the array; it expects BGR channel order
+        if not cv2.imwrite(str(path), array[..., ::-1], [cv2.IMWRITE_PNG_COMPRESSION, compress_level]):
+            raise OSError(f"Could not write {path}")
+        return
+    
+    Image.fromarray(array).save(path, 'PNG', compress_level=compress_level, optimize=False)
+
+def _group_images(
+    files: List[Path],
+    rows: List[int],
+    max_images: int,
+    max_rows: int
+) -> Tuple[List[List[Path]], List[int]]:
+    """Group consecutive images into tasks of at most max_images images and max_rows patches.
+    
+    Returns the tasks and the estimated patch count of each.
+    """
+    tasks, task_rows = [], []
+    for path, count in zip(files, rows):
+        if tasks and len(tasks[-1]) < max_images and task_rows[-1] + count <= max_rows:
+            tasks[-1].append(path)
+            task_rows[-1] += count
+        else:
+            tasks.append([path])
+            task_rows.append(count)
+    return tasks, task_rows
+
+def _ring_views(buffer, slots: int, rows: int, patch_size: int, lr_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """HR and LR (slots, rows, size, size, 3) arrays laid out back to back in a shared buffer."""
+    hr = np.ndarray((slots, rows, patch_size, patch_size, 3), dtype=np.uint8, buffer=buffer)
+    lr = np.ndarray((slots, rows, lr_size, lr_size, 3), dtype=np.uint8, buffer=buffer, offset=hr.nbytes)
+    return hr, lr
+
+def _ring_slot_rows(slots: int, row_bytes: int) -> int:
+    """Patch rows per slot that keep the ring within _RING_BYTES and the free space of /dev/shm."""
+    budget = min(_RING_BYTES, slots * _SLOT_BYTES)
+    try:
+        # Linux backs shared memory with a tmpfs that is only filled on write, so an
+        # oversized ring is created fine and then kills workers with SIGBUS. Leave
+        # half of it for everything else
+        budget = min(budget, shutil.disk_usage('/dev/shm').free // 2)
+    except OSError:
+        pass
+    return budget // (slots * row_bytes)
+
+# Shared-memory ring this worker process is attached to, reused across tasks
+_worker_ring = {}
+
+def _attach_ring(name: str, slots: int, rows: int, patch_size: int, lr_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Views of the parent's shared-memory ring, attaching on first use."""
+    if _worker_ring.get('name') != name:
+        # Drop the views before closing, or close() finds the buffer still exported
+        previous = _worker_ring.pop('shm', None)
+        _worker_ring.clear()
+        if previous is not None:
+            previous.close()
+        
+        shm = SharedMemory(name=name)
+        _worker_ring.update(name=name, shm=shm,
+                            views=_ring_views(shm.buf, slots, rows, patch_size, lr_size))
+    return _worker_ring['views']
+
+def _submit_bounded(ex: ProcessPoolExecutor, worker, tasks: List[List[Path]], slots: int):
+    """Run tasks on the pool with at most `slots` of them in flight.
+    
+    Every in-flight task gets a slot number no other in-flight task holds.
+    Yields (task, slot, results) in submission order; a slot is handed to a
+    new task only after the consumer has asked for the next item.
+    """
+    free_slots = list(range(slots))
+    pending = deque()
+    
+    for task in tasks:
+        if not free_slots:
+            done, slot, future = pending.popleft()
+            yield done, slot, future.result()
+            free_slots.append(slot)
+        slot = free_slots.pop()
+        pending.append((task, slot, ex.submit(worker, task, slot=slot)))
+    
+    while pending:
+        done, slot, future = pending.popleft()
+        yield done, slot, future.result()
+
+def _mp_context():
+    """Multiprocessing context for the worker pool.
+    
+    forkserver keeps workers from inheriting the parent's PIL/numpy state via
+    copy-on-write; it is not available on every platform.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+def _decode_image(img_path: Path, patch_size: int, max_source_size: Optional[int] = None) -> Optional[Image.Image]:
+    """Open and decode a source image, or return None if it cannot be used."""
+    try:
+        image = Image.open(img_path)
+        
+        # Let libjpeg skip IDCT work by decoding at a reduced scale
+        if max_source_size and img_path.suffix.lower() in ('.jpg', '.jpeg'):
+            image.draft('RGB', (max_source_size, max_source_size))
+        image = image.convert('RGB')
+    except Exception as e:
+        print(f"  Error processing {img_path.name}: {e}")
+        return None
+    
+    # Skip small images
+    if image.width < patch_size or image.height < patch_size:
+        print(f"  Skipping {img_path.name} (too small)")
+        return None
+    
+    return image
+
+def _cut_patches(
+    image: Image.Image,
+    patch_size: int,
+    stride: Optional[int],
+    scale: int,
+    augmentations: List[str],
+    min_patch_var: float,
+    lr_method: str = 'bicubic'
+) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Cut an image into HR/LR patch batches.
+    
+    Returns (hr_patches, lr_patches, rejected).
+    """
+    array = np.asarray(image)
+    stride = stride or patch_size
+    rejected = 0
+    
+    # Find patches worth keeping (skip uniform patches) before copying anything
+    ys, xs = _patch_grid(image.size, patch_size, stride)
+    keep = np.ones((len(ys), len(xs)), dtype=bool)
+    if min_patch_var > 0:
+        keep = _patch_variances(array, ys, xs, patch_size, stride) >= min_patch_var
+        rejected = keep.size - int(np.count_nonzero(keep))
+    
+    patches = create_patches(array, patch_size, stride, keep)
+    
+    # Create LR patches. When the patch grid lands on whole LR pixels, downscale
+    # the full image once and tile it on the same grid, which also gives border
+    # pixels their real neighbours instead of the patch edge
+    if patch_size % scale == 0 and stride % scale == 0:
+        # Trim to whole LR pixels so the resize ratio is exactly `scale`; every
+        # patch on the grid still fits inside
+        lr_source = image.crop((0, 0, image.width - image.width % scale,
+                                image.height - image.height % scale))
+        lr_image = downscale_image(lr_source, scale, lr_method)
+        lr_patches = create_patches(lr_image, patch_size // scale, stride // scale, keep)
+    else:
+        lr_patches = downscale_patches(patches, scale, lr_method)
+    
+    # Apply augmentations (flips and quarter turns commute with the downscale)
+    if augmentations:
+        patches = augment_batch(patches, augmentations)
+        lr_patches = augment_batch(lr_patches, augmentations)
+    
+    return patches, lr_patches, rejected
+
+def _process_images(
+    img_paths: List[Path],
+    hr_dir: Path,
+    lr_dir: Path,
+    patch_size: int,
+    stride: Optional[int],
+    scale: int,
+    augmentations: List[str],
+    min_patch_var: float,
+    lr_method: str = 'bicubic',
+    png_compress_level: int = 1,
+    max_source_size: Optional[int] = None,
+    ring: Optional[Tuple[str, int, int]] = None,
+    slot: int = 0,
+    output_format: str = 'png'
+) -> List[Tuple[int, int, Optional[Tuple[np.ndarray, np.ndarray]]]]:
+    """Run a group of source images through a decode -> patch -> save pipeline.
+    
+    Decoding and patch extraction each run on their own thread and hand work
+    on through bounded queues, while the calling thread saves. Decoding, resizing
+    and PNG encoding release the GIL, so the stages overlap.
+    
+    For the png format, patches are saved directly into hr_dir and lr_dir.
+    For npy/tar, the patches of all images are copied back to back into slot
+    `slot` of the parent's shared-memory ring (name, slots, rows per slot),
+    so only counts travel back through the pool; the parent appends them to
+    the output. Patches that do not fit the slot, or all of them when there
+    is no ring, are returned as (hr, lr) arrays instead.
+    
+    Returns one (patches_written, rejected, arrays) tuple per image, in order;
+    arrays is None unless the patches were returned directly.
+    """
+    decoded = queue.Queue(maxsize=_DECODE_DEPTH)
+    cut = queue.Queue(maxsize=_CUT_DEPTH)
+    
+    def decode_stage():
+        try:
+            for img_path in img_paths:
+                decoded.put((img_path, _decode_image(img_path, patch_size, max_source_size)))
+        finally:
+            decoded.put(None)
+    
+    def patch_stage():
+        try:
+            for img_path, image in iter(decoded.get, None):
+                result = None
+                if image is not None:
+                    try:
+                        result = _cut_patches(image, patch_size, stride, scale, augmentations,
+                                              min_patch_var, lr_method)
+                    except Exception as e:
+                        print(f"  Error processing {img_path.name}: {e}")
+                cut.put((img_path, result))
+        finally:
+            cut.put(None)
+    
+    stages = [threading.Thread(target=decode_stage, daemon=True),
+              threading.Thread(target=patch_stage, daemon=True)]
+    for stage in stages:
+        stage.start()
+    
+    ring_hr = ring_lr = None
+    if ring is not None:
+        ring_hr, ring_lr = _attach_ring(*ring, patch_size, patch_size // scale)
+        ring_hr, ring_lr = ring_hr[slot], ring_lr[slot]
+    offset = 0
+    
+    results = []
+    with ThreadPoolExecutor(max_workers=_SAVE_THREADS) as save_pool:
+        for img_path, result in iter(cut.get, None):
+            if result is None:
+                results.append((0, 0, None))
+                continue
+            
+            patches, lr_patches, rejected = result
+            written = 0
+            arrays = None
+            
+            try:
+                if output_format == 'png':
+                    # OpenCV and PIL both release the GIL while encoding and writing, so HR
+                    # and LR saves overlap in threads
+                    saves = []
+                    for patch_idx, (patch, lr_patch) in enumerate(zip(patches, lr_patches)):
+                        base_name = f"{img_path.stem}_{patch_idx:04d}.png"
+                        saves.append(save_pool.submit(_save_png, patch, hr_dir / base_name, png_compress_level))
+                        saves.append(save_pool.submit(_save_png, lr_patch, lr_dir / base_name, png_compress_level))
+                    
+                    # Surface any save error
+                    for save in saves:
+                        save.result()
+                    written = len(patches)
+                elif ring_hr is not None and offset + len(patches) <= len(ring_hr):
+                    end = offset + len(patches)
+                    ring_hr[offset:end] = patches
+                    ring_lr[offset:end] = lr_patches
+                    offset = end
+                    written = len(patches)
+                else:
+                    if len(patches):
+                        arrays = (patches, lr_patches)
+                    written = len(patches)
+            except Exception as e:
+                print(f"  Error processing {img_path.name}: {e}")
+            
+            results.append((written, rejected, arrays))
+    
+    for stage in stages:
+        stage.join()
+    
+    return results
 
 def process_dataset(
     input_dir: Path,
@@ -74,7 +578,11 @@ def process_dataset(
     stride: Optional[int] = None,
     augmentations: List[str] = [],
     train_split: float = 0.8,
-    min_patch_std: float = 0.0
+    min_patch_std: float = 0.0,
+    workers: Optional[int] = None,
+    png_compress_level: int = 1,
+    output_format: str = 'png',
+    max_source_size: Optional[int] = None
 ):
     """Process a directory of images into a training dataset."""
     
@@ -84,8 +592,10 @@ def process_dataset(
     val_hr_dir = output_dir / 'validation' / 'HR'
     val_lr_dir = output_dir / 'validation' / f'LR_x{scale}'
     
-    for dir_path in [train_hr_dir, train_lr_dir, val_hr_dir, val_lr_dir]:
-        dir_path.mkdir(parents=True, exist_ok=True)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if output_format == 'png':
+        for dir_path in [train_hr_dir, train_lr_dir, val_hr_dir, val_lr_dir]:
+            dir_path.mkdir(parents=True, exist_ok=True)
     
     # Get all image files
     image_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff'}
@@ -106,62 +616,104 @@ def process_dataset(
     
     print(f"Train: {len(train_files)} images, Validation: {len(val_files)} images")
     
-    patch_count = 0
+    split_counts = {'train': 0, 'validation': 0}
     rejected_count = 0
     
-    for idx, (files, is_train) in enumerate([(train_files, True), (val_files, False)]):
-        hr_dir = train_hr_dir if is_train else val_hr_dir
-        lr_dir = train_lr_dir if is_train else val_lr_dir
-        dataset_name = "training" if is_train else "validation"
-        
-        print(f"\nProcessing {dataset_name} set...")
-        
-        for img_path in files:
-            try:
-                image = Image.open(img_path).convert('RGB')
-                
-                # Skip small images
-                if image.width < patch_size or image.height < patch_size:
-                    print(f"  Skipping {img_path.name} (too small)")
-                    continue
-                
-                # Extract patches
-                patches = create_patches(image, patch_size, stride)
-                
-                # Apply augmentations
-                if is_train and augmentations:
-                    augmented_patches = []
-                    for patch in patches:
-                        augmented_patches.extend(augment_image(patch, augmentations))
-                    patches = augmented_patches
-                
-                # Save patches
-                for patch_idx, patch in enumerate(patches):
-                    # Check patch variance (skip uniform patches)
-                    if min_patch_std > 0:
-                        patch_array = np.array(patch)
-                        if np.std(patch_array) < min_patch_std:
-                            rejected_count += 1
-                            continue
-                    
-                    # Create filenames
-                    base_name = f"{img_path.stem}_{patch_idx:04d}.png"
-                    hr_path = hr_dir / base_name
-                    lr_path = lr_dir / base_name
-                    
-                    # Save HR patch
-                    patch.save(hr_path, 'PNG')
-                    
-                    # Create and save LR patch
-                    lr_patch = downscale_image(patch, scale)
-                    lr_patch.save(lr_path, 'PNG')
-                    
-                    patch_count += 1
+    # For power-of-two factors use BOX (plain area averaging) as a cheaper
+    # substitute for bicubic. It is not equivalent: bicubic's negative lobes
+    # give sharper LR images, so this changes the degradation the model learns
+    lr_method = 'box' if scale & (scale - 1) == 0 else 'bicubic'
+    
+    # Workers compare patch variances, so square the threshold once up front
+    min_patch_var = min_patch_std * min_patch_std if min_patch_std > 0 else 0.0
+    
+    # Images are independent, so fan them out across processes
+    with ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context()) as ex:
+        for idx, (files, is_train) in enumerate([(train_files, True), (val_files, False)]):
+            hr_dir = train_hr_dir if is_train else val_hr_dir
+            lr_dir = train_lr_dir if is_train else val_lr_dir
+            dataset_name = "training" if is_train else "validation"
+            split = 'train' if is_train else 'validation'
+            split_augmentations = augmentations if is_train else []
+            
+            worker = partial(
+                _process_images,
+                hr_dir=hr_dir,
+                lr_dir=lr_dir,
+                patch_size=patch_size,
+                stride=stride,
+                scale=scale,
+                augmentations=split_augmentations,
+                min_patch_var=min_patch_var,
+                lr_method=lr_method,
+                png_compress_level=png_compress_level,
+                max_source_size=max_source_size,
+                output_format=output_format
+            )
+            
+            # Hand out groups of images so each worker can keep its pipeline full,
+            # but small enough that every worker gets a share
+            n_workers = workers or os.cpu_count() or 1
+            per_task = max(1, min(_IMAGES_PER_TASK, len(files) // n_workers))
+            # Enough slots to queue a second task behind each running one
+            ring_slots = 2 * n_workers
+            
+            writer = None
+            shm = None
+            if output_format == 'png':
+                tasks = [files[i:i + per_task] for i in range(0, len(files), per_task)]
+            else:
+                # Workers copy patches into a shared-memory ring and return only counts,
+                # so no patch data is pickled between processes
+                lr_size = patch_size // scale
+                row_bytes = 3 * (patch_size * patch_size + lr_size * lr_size)
+                copies = len(augment_batch(np.zeros((1, 1, 1, 3), dtype=np.uint8), split_augmentations))
+                rows = [_estimate_patches(path, patch_size, stride or patch_size, copies) for path in files]
+                cap_rows = _ring_slot_rows(ring_slots, row_bytes)
+                tasks, task_rows = _group_images(files, rows, per_task, max(1, cap_rows))
+                slot_rows = min(cap_rows, max(task_rows, default=0))
                 
-                print(f"  Processed {img_path.name}: {len(patches)} patches")
+                if slot_rows:
+                    try:
+                        shm = SharedMemory(create=True, size=ring_slots * slot_rows * row_bytes)
+                    except OSError as e:
+                        print(f"  Shared memory unavailable ({e}), returning patches through the pool")
+                if shm is not None:
+                    ring_hr, ring_lr = _ring_views(shm.buf, ring_slots, slot_rows, patch_size, lr_size)
+                    worker = partial(worker, ring=(shm.name, ring_slots, slot_rows))
                 
-            except Exception as e:
-                print(f"  Error processing {img_path.name}: {e}")
+                if output_format == 'npy':
+                    writer = _NpyWriter(output_dir, split, sum(task_rows), patch_size, lr_size)
+                else:
+                    writer = _TarWriter(output_dir, split)
+            
+            try:
+                with tqdm(total=len(files), desc=dataset_name, unit='img') as progress:
+                    for task, slot, results in _submit_bounded(ex, worker, tasks, ring_slots):
+                        offset = 0
+                        for img_path, (written, rejected, arrays) in zip(task, results):
+                            split_counts[split] += written
+                            rejected_count += rejected
+                            if arrays is not None:
+                                writer.write(img_path.stem, *arrays)
+                            elif writer is not None and written:
+                                end = offset + written
+                                writer.write(img_path.stem, ring_hr[slot, offset:end],
+                                             ring_lr[slot, offset:end])
+                                offset = end
+                            progress.update()
+                        progress.set_postfix(patches=split_counts[split], rejected=rejected_count,
+                                             refresh=False)
+            finally:
+                if writer is not None:
+                    writer.close()
+                if shm is not None:
+                    # Views must go before the mapping can be closed
+                    del ring_hr, ring_lr
+                    shm.close()
+                    shm.unlink()
+    
+    patch_count = split_counts['train'] + split_counts['validation']
     
     print(f"\nDataset creation complete!")
     print(f"Total patches created: {patch_count}")
@@ -179,47 +731,48 @@ def process_dataset(
         f.write(f"Stride: {stride if stride else patch_size}\n")
         f.write(f"Augmentations: {', '.join(augmentations) if augmentations else 'None'}\n")
         f.write(f"Train/Val split: {train_split:.0%}/{(1-train_split):.0%}\n")
+        f.write(f"Output format: {output_format}\n")
         f.write(f"Total patches: {patch_count}\n")
-        f.write(f"Training patches: {len(list(train_hr_dir.iterdir()))}\n")
-        f.write(f"Validation patches: {len(list(val_hr_dir.iterdir()))}\n")
+        f.write(f"Training patches: {split_counts['train']}\n")
+        f.write(f"Validation patches: {split_counts['validation']}\n")
     
     print(f"\nDataset info saved to: {info_file}")
 
-def create_test_images(output_dir: Path, count: int = 10):
+def create_test_images(output_dir: Path, count: int = 10, seed: Optional[int] = None):
     """Create synthetic test images for testing the pipeline."""
     output_dir.mkdir(parents=True, exist_ok=True)
     
     print(f"Creating {count} synthetic test images...")
     
+    rng = np.random.default_rng(seed)
+    
     for i in range(count):
         # Create random image with patterns
-        size = random.randint(256, 512)
-        image = Image.new('RGB', (size, size))
-        pixels = image.load()
+        size = int(rng.integers(256, 513))
         
-        # Add some patterns
-        for y in range(size):
-            for x in range(size):
-                # Gradient with noise
-                r = int((x / size) * 255 + random.randint(-20, 20))
-                g = int((y / size) * 255 + random.randint(-20, 20))
-                b = int(((x + y) / (2 * size)) * 255 + random.randint(-20, 20))
-                
-                r = max(0, min(255, r))
-                g = max(0, min(255, g))
-                b = max(0, min(255, b))
-                
-                pixels[x, y] = (r, g, b)
+        # Gradient with noise, built in one vectorized pass
+        xs = np.arange(size, dtype=np.float32)
+        ys = xs[:, None]
+        noise = rng.integers(-20, 21, size=(3, size, size), dtype=np.int16)
+        r = xs * (255 / size) + noise[0]
+        g = ys * (255 / size) + noise[1]
+        b = (xs + ys) * (255 / (2 * size)) + noise[2]
+        
+        arr = np.stack([r, g, b], axis=-1)
+        image = Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8))
         
         # Add some geometric shapes
         from PIL import ImageDraw
         draw = ImageDraw.Draw(image)
-        for _ in range(random.randint(3, 8)):
-            shape_type = random.choice(['rectangle', 'ellipse'])
-            color = tuple(random.randint(0, 255) for _ in range(3))
-            x1, y1 = random.randint(0, size//2), random.randint(0, size//2)
-            x2, y2 = random.randint(size//2, size), random.randint(size//2, size)
-            
+        n_shapes = int(rng.integers(3, 9))
+        kinds = rng.choice(['rectangle', 'ellipse'], n_shapes)
+        colors = rng.integers(0, 256, size=(n_shapes, 3))
+        # Top-left corners in the first half, bottom-right corners in the second
+        corners = np.hstack([rng.integers(0, size//2 + 1, size=(n_shapes, 2)),
+                             rng.integers(size//2, size + 1, size=(n_shapes, 2))])
+        
+        for shape_type, color, (x1, y1, x2, y2) in zip(kinds, map(tuple, colors.tolist()),
+                                                       corners.tolist()):
             if shape_type == 'rectangle':
                 draw.rectangle([x1, y1, x2, y2], fill=color, outline=color)
             else:
@@ -229,6 +782,16 @@ def create_test_images(output_dir: Path, count: int = 10):
     
     print(f"Test images saved to: {output_dir}")
 
+def _positive_int(value: str) -> int:
+    """argparse type for options that need a count of at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid integer: {value!r}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
 def main():
     parser = argparse.ArgumentParser(description='Create training dataset for SRGAN-Rust')
     parser.add_argument('input_dir', type=Path, help='Input directory containing images')
@@ -242,13 +805,32 @@ def main():
                        help='Proportion of data for training (0-1)')
     parser.add_argument('--min-std', type=float, default=10.0,
                        help='Minimum standard deviation for patches (filters uniform patches)')
+    parser.add_argument('--workers', type=_positive_int, default=os.cpu_count(),
+                       help='Number of worker processes (default: CPU count)')
+    parser.add_argument('--png-compress-level', type=int, default=1, choices=range(10),
+                       metavar='{0-9}',
+                       help='zlib level for PNG output; 1 (Z_BEST_SPEED) encodes several times '
+                            'faster than the default 6 at a modest size cost')
+    parser.add_argument('--format', choices=['png', 'npy', 'tar'], default='png',
+                       help='Output layout: PNG files per patch, one memory-mapped .npy array '
+                            'per split, or one WebDataset-style tar shard per split')
+    parser.add_argument('--max-source-size', type=_positive_int,
+                       help='Decode JPEG sources at a reduced scale, keeping at least this many '
+                            'pixels per side (patches are then cut from the smaller image)')
     parser.add_argument('--create-test', action='store_true',
                        help='Create synthetic test images in input directory')
+    parser.add_argument('--seed', type=int,
+                       help='Random seed for the synthetic test images')
     
     args = parser.parse_args()
     
+    # A JPEG drafted below the patch size would be skipped as too small
+    if args.max_source_size is not None and args.max_source_size < args.patch_size:
+        parser.error(f"--max-source-size ({args.max_source_size}) must be at least "
+                     f"--patch-size ({args.patch_size})")
+    
     if args.create_test:
-        create_test_images(args.input_dir)
+        create_test_images(args.input_dir, seed=args.seed)
     
     if not args.input_dir.exists():
         print(f"Error: Input directory {args.input_dir} does not exist")
@@ -265,7 +847,11 @@ def main():
         args.stride,
         args.augment or [],
         args.train_split,
-        args.min_std
+        args.min_std,
+        args.workers,
+        args.png_compress_level,
+        args.format,
+        args.max_source_size
     )
 
 if __name__ == '__main__':